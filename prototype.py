@@ -1,9 +1,13 @@
 import sys
 import sqlite3
+import threading
 import logging
-from typing import Self
+from itertools import chain
+from operator import attrgetter
+from types import TracebackType
+from typing import Any, Literal, Self
 from enum import Enum
-from pydantic import BaseModel  # This works for Pydantic v2 as well
+from pydantic import BaseModel, ConfigDict, TypeAdapter  # This works for Pydantic v2 as well
 
 
 logger = logging.getLogger()
@@ -35,28 +39,48 @@ class IngredientCategory(str, Enum):
     SPICE = "spice"
 
 
-class Ingredient(BaseModel):
+class RecipeBaseModel(BaseModel):
+    # Unknown fields raise a ValidationError instead of being silently ignored.
+    model_config = ConfigDict(extra="forbid")
+
+
+class Ingredient(RecipeBaseModel):
     name: str
     category: IngredientCategory | None = None
 
+    @classmethod
+    def from_trusted(cls, data: dict[str, Any]) -> Self:
+        category = data.get("category")
+        return cls.model_construct(
+            name=data["name"],
+            category=IngredientCategory(category) if category is not None else None,
+        )
+
 
-class RecipeIngredient(BaseModel):
+class RecipeIngredient(RecipeBaseModel):
     ingredient: Ingredient
     quantity: float
     unit: Unit
 
+    @classmethod
+    def from_trusted(cls, data: dict[str, Any]) -> Self:
+        return cls.model_construct(
+            ingredient=Ingredient.from_trusted(data["ingredient"]),
+            quantity=data["quantity"],
+            unit=Unit(data["unit"]),
+        )
+
 
-class Instruction(BaseModel):
+class Instruction(RecipeBaseModel):
     step_number: int
     description: str
 
 
-class Tag(BaseModel):
+class Tag(RecipeBaseModel):
     name: str
-    children: Self | None = None  # Optional nested tags
 
 
-class Recipe(BaseModel):
+class Recipe(RecipeBaseModel):
     title: str
     description: str | None = None
     comments: str | None = None
@@ -67,12 +91,138 @@ class Recipe(BaseModel):
     instructions: list[Instruction | None]
     tags: list[Tag | None]
 
+    @classmethod
+    def from_trusted(cls, data: dict[str, Any]) -> Self:
+        """Build a recipe tree without validation, for data that is already known to be valid.
+
+        Meant for data we produced ourselves, such as rows read back from our own
+        database or a previous model_dump(). Enum fields may be given as members or
+        raw values and None list entries are kept as they are; nothing else is checked.
+        """
+        fields = {key: value for key, value in data.items() if key not in ("ingredients", "instructions", "tags")}
+        return cls.model_construct(
+            **fields,
+            ingredients=[RecipeIngredient.from_trusted(ri) if ri is not None else None for ri in data["ingredients"]],
+            instructions=[
+                Instruction.model_construct(**instr) if instr is not None else None for instr in data["instructions"]
+            ],
+            tags=[Tag.model_construct(name=tag["name"]) if tag is not None else None for tag in data["tags"]],
+        )
+
 
 # ------------------------------
 # SQLite Database Functions
 # ------------------------------
 
-def create_tables(conn: sqlite3.Connection):
+# SQL used on the insert path. Keeping each statement in one constant means every
+# call passes the same string, so it is served from the connection's statement cache.
+SQL_INSERT_MISSING_INGREDIENT = "INSERT OR IGNORE INTO ingredients (name, category) VALUES (?, ?)"
+SQL_INSERT_MISSING_TAG = "INSERT OR IGNORE INTO tags (name) VALUES (?)"
+# The version is one past the group's latest, read off idx_recipes_group_version.
+# A NULL group matches no rows, so a new recipe starts at version 1.
+SQL_INSERT_RECIPE = (
+    "INSERT INTO recipes (group_id, version, title, description, comments, prep_time, cook_time, servings, "
+    "ingredients_json, tags_json) "
+    "VALUES (?, (SELECT COALESCE(MAX(version), 0) + 1 FROM recipes WHERE group_id = ?), ?, ?, ?, ?, ?, ?, ?, ?) "
+    "RETURNING id, version"
+)
+# Child rows are written with insert_rows(), which appends one VALUES group per row.
+SQL_INSERT_INSTRUCTION = "INSERT INTO instructions (recipe_id, step_number, description)"
+SQL_INSERT_RECIPE_INGREDIENT = "INSERT INTO recipe_ingredients (recipe_id, ingredient_id, quantity, unit)"
+SQL_INSERT_RECIPE_TAG = "INSERT INTO recipe_tags (recipe_id, tag_id)"
+
+# Field getters for building child rows; attrgetter fetches all fields in one C call.
+_instruction_fields = attrgetter("step_number", "description")
+_recipe_ingredient_fields = attrgetter("ingredient.name", "quantity", "unit.value")
+
+# Serializers for the ingredients_json and tags_json columns.
+_ingredients_json = TypeAdapter(list[RecipeIngredient])
+_tags_json = TypeAdapter(list[Tag])
+
+# Lowest SQLITE_MAX_VARIABLE_NUMBER across SQLite versions (raised to 32766 in 3.32).
+MAX_SQL_PARAMETERS = 999
+
+
+class RecipeConnection(sqlite3.Connection):
+    """sqlite3 connection that remembers the ids of ingredients and tags it has resolved.
+
+    Ids first seen inside a transaction are kept as pending: they are valid for
+    the rest of that transaction and move into ingredient_ids/tag_ids when
+    commit() succeeds. rollback() and a failing ``with conn:`` block discard them,
+    and insert_recipe discards any left over when it finds no transaction open,
+    which covers a raw ROLLBACK statement. End transactions through commit() or
+    rollback() rather than raw statements to keep the pending ids accurate.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.ingredient_ids: dict[str, int] = {}
+        self.tag_ids: dict[str, int] = {}
+        self.pending_ingredient_ids: dict[str, int] = {}
+        self.pending_tag_ids: dict[str, int] = {}
+
+    def cached_ingredient_id(self, name: str) -> int | None:
+        ingredient_id = self.ingredient_ids.get(name)
+        return ingredient_id if ingredient_id is not None else self.pending_ingredient_ids.get(name)
+
+    def cached_tag_id(self, name: str) -> int | None:
+        tag_id = self.tag_ids.get(name)
+        return tag_id if tag_id is not None else self.pending_tag_ids.get(name)
+
+    def clear_caches(self) -> None:
+        self.ingredient_ids.clear()
+        self.tag_ids.clear()
+        self.clear_pending()
+
+    def clear_pending(self) -> None:
+        self.pending_ingredient_ids.clear()
+        self.pending_tag_ids.clear()
+
+    def commit(self) -> None:
+        committing = self.in_transaction
+        super().commit()
+        if committing:
+            self.ingredient_ids.update(self.pending_ingredient_ids)
+            self.tag_ids.update(self.pending_tag_ids)
+        self.clear_pending()
+
+    def rollback(self) -> None:
+        super().rollback()
+        self.clear_pending()
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> Literal[False]:
+        # sqlite3's own __exit__ calls the C commit/rollback and would bypass the overrides.
+        if exc_type is None:
+            try:
+                self.commit()
+            except Exception:
+                self.rollback()
+                raise
+        else:
+            self.rollback()
+        return False
+
+
+def configure_connection(conn: sqlite3.Connection) -> None:
+    """Apply the PRAGMAs used for bulk inserts.
+
+    WAL relies on shared memory, so the database file must live on a local disk
+    and not on a network mount.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
+    conn.execute("PRAGMA analysis_limit=1000")  # Bound the cost of ANALYZE and PRAGMA optimize
+
+
+def create_tables(conn: sqlite3.Connection) -> None:
     """Create the recipes, ingredients, instructions, tags, and join tables."""
     with conn:
         conn.execute("""
@@ -85,9 +235,16 @@ def create_tables(conn: sqlite3.Connection):
                 comments TEXT,
                 prep_time INTEGER,
                 cook_time INTEGER,
-                servings INTEGER
+                servings INTEGER,
+                ingredients_json TEXT,  -- set instead of the join tables when stored with json_children
+                tags_json TEXT
             );
         """)
+        # Databases created before the JSON columns existed get them added in place.
+        recipe_columns = {row[1] for row in conn.execute("PRAGMA table_info(recipes)")}
+        for column in ("ingredients_json", "tags_json"):
+            if column not in recipe_columns:
+                conn.execute(f"ALTER TABLE recipes ADD COLUMN {column} TEXT")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS ingredients (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -130,94 +287,231 @@ def create_tables(conn: sqlite3.Connection):
                 FOREIGN KEY (tag_id) REFERENCES tags(id) ON DELETE CASCADE
             );
         """)
+        # A recipe inserted without a group starts its own group, keyed by its id.
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS set_recipe_group_id AFTER INSERT ON recipes
+            WHEN NEW.group_id IS NULL
+            BEGIN
+                UPDATE recipes SET group_id = NEW.id WHERE id = NEW.id;
+            END;
+        """)
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_ingredients_name ON ingredients(name)")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_tags_name ON tags(name)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_recipes_group_version ON recipes(group_id, version)")
+
+
+DB_PATH = "oppskrifter.db"
+
+# One connection per thread and database path, configured on first use.
+_local = threading.local()
+
+
+def get_conn(path: str = DB_PATH) -> RecipeConnection:
+    """Return this thread's connection to path, opening and configuring it on first use.
+
+    Reusing the connection keeps its statement cache, id caches and page cache
+    warm, and runs the PRAGMAs and schema setup only once per thread.
+    """
+    conns: dict[str, RecipeConnection] | None = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, factory=RecipeConnection, cached_statements=512, isolation_level=None)
+        configure_connection(conn)
+        create_tables(conn)
+        conns[path] = conn
+    return conn
+
+
+def close_conn(path: str = DB_PATH) -> None:
+    """Run PRAGMA optimize and close this thread's connection to path, if open."""
+    conn = getattr(_local, "conns", {}).pop(path, None)
+    if conn is None:
+        return
+    try:
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
 
 
 # ------------------------------
 # Helper Insertion Functions
 # ------------------------------
 
-def get_or_create_ingredient(conn: sqlite3.Connection, ingredient: Ingredient) -> int:
-    cur = conn.execute("SELECT id FROM ingredients WHERE name = ?", (ingredient.name,))
-    row = cur.fetchone()
-    if row:
-        logger.info(f"Ingredient {ingredient.name} already exists")
-        return row[0]
-    cur = conn.execute("INSERT INTO ingredients (name, category) VALUES (?, ?)", (ingredient.name, ingredient.category))
-    logger.info(f"Inserted ingredient {ingredient.name} with ID {cur.lastrowid}")
-    return cur.lastrowid
-
-
-def get_or_create_tag(conn: sqlite3.Connection, tag: Tag) -> int:
-    cur = conn.execute("SELECT id FROM tags WHERE name = ?", (tag.name,))
-    row = cur.fetchone()
-    if row:
-        logger.info(f"Tag {tag.name} already exists")
-        return row[0]
-    cur = conn.execute("INSERT INTO tags (name) VALUES (?)", (tag.name,))
-    logger.info(f"Inserted Tag {tag.name} with ID {cur.lastrowid}")
-    return cur.lastrowid
-
-
-def insert_recipe(conn: sqlite3.Connection, recipe: Recipe, group_id: int | None = None) -> int:
-
-    if group_id is None:
-        # New recipe, version 1
-        cur = conn.execute(
-            "INSERT INTO recipes (group_id, version, title, description, comments, prep_time, cook_time, servings) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (None, 1, recipe.title, recipe.description, recipe.comments, recipe.prep_time, recipe.cook_time, recipe.servings)
-        )
-        recipe_id = cur.lastrowid
-        # Use the inserted id as the group_id for subsequent versions.
-        conn.execute("UPDATE recipes SET group_id = ? WHERE id = ?", (recipe_id, recipe_id))
-        group_id = recipe_id
-        version = 1
-    else:
-        # Insert a new version for an existing recipe group.
-        cur = conn.execute("SELECT MAX(version) FROM recipes WHERE group_id = ?", (group_id,))
-        max_version = cur.fetchone()[0] or 0
-        version = max_version + 1
-        cur = conn.execute(
-            "INSERT INTO recipes (group_id, version, title, description, comments, prep_time, cook_time, servings) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (group_id, version, recipe.title, recipe.description, recipe.comments, recipe.prep_time, recipe.cook_time, recipe.servings)
-        )
-        recipe_id = cur.lastrowid
+def insert_rows(conn: sqlite3.Connection, insert_sql: str, rows: list[tuple[Any, ...]]) -> None:
+    """Insert rows with one multi-row VALUES statement per chunk.
+
+    Chunks are sized to stay under MAX_SQL_PARAMETERS. Each chunk size yields a
+    distinct SQL string, and each of those is cached like any other statement.
+    """
+    if not rows:
+        return
+    row_placeholder = "(" + ", ".join("?" * len(rows[0])) + ")"
+    chunk_size = MAX_SQL_PARAMETERS // len(rows[0])
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        values = ", ".join([row_placeholder] * len(chunk))
+        conn.execute(f"{insert_sql} VALUES {values}", list(chain.from_iterable(chunk)))
+
+
+def _select_ids_by_name(conn: sqlite3.Connection, table: str, names: list[str]) -> dict[str, int]:
+    ids: dict[str, int] = {}
+    for start in range(0, len(names), MAX_SQL_PARAMETERS):
+        chunk = names[start:start + MAX_SQL_PARAMETERS]
+        placeholders = ", ".join("?" * len(chunk))
+        cur = conn.execute(f"SELECT name, id FROM {table} WHERE name IN ({placeholders})", chunk)
+        ids.update(cur.fetchall())
+    return ids
+
+
+def resolve_ingredient_ids(conn: sqlite3.Connection, ingredients: list[Ingredient]) -> dict[str, int]:
+    """Return a name -> id mapping for the given ingredients, creating missing ones.
+
+    Names not in the connection's id cache are looked up with one SELECT; those
+    still missing are inserted with one executemany and read back with a second
+    SELECT. The cache is only used when conn is a RecipeConnection.
+    """
+    by_name = {ing.name: ing for ing in ingredients}
+    ids: dict[str, int] = {}
+    if isinstance(conn, RecipeConnection):
+        for name in by_name:
+            ingredient_id = conn.cached_ingredient_id(name)
+            if ingredient_id is not None:
+                ids[name] = ingredient_id
+    uncached = [name for name in by_name if name not in ids]
+    if uncached:
+        found = _select_ids_by_name(conn, "ingredients", uncached)
+        missing = [by_name[name] for name in uncached if name not in found]
+        if missing:
+            conn.executemany(
+                SQL_INSERT_MISSING_INGREDIENT,
+                [(ing.name, ing.category) for ing in missing]
+            )
+            missing_names = [ing.name for ing in missing]
+            found.update(_select_ids_by_name(conn, "ingredients", missing_names))
+            logger.info("Inserted ingredients %s", missing_names)
+        ids.update(found)
+        if isinstance(conn, RecipeConnection):
+            conn.pending_ingredient_ids.update(found)
+    return ids
+
+
+def resolve_tag_ids(conn: sqlite3.Connection, tags: list[Tag]) -> dict[str, int]:
+    """Return a name -> id mapping for the given tags, creating missing ones."""
+    # dict.fromkeys keeps first-seen order, so new tags get ids in recipe order.
+    names = dict.fromkeys(tag.name for tag in tags)
+    ids: dict[str, int] = {}
+    if isinstance(conn, RecipeConnection):
+        for name in names:
+            tag_id = conn.cached_tag_id(name)
+            if tag_id is not None:
+                ids[name] = tag_id
+    uncached = [name for name in names if name not in ids]
+    if uncached:
+        found = _select_ids_by_name(conn, "tags", uncached)
+        missing = [name for name in uncached if name not in found]
+        if missing:
+            conn.executemany(SQL_INSERT_MISSING_TAG, [(name,) for name in missing])
+            found.update(_select_ids_by_name(conn, "tags", missing))
+            logger.info("Inserted tags %s", missing)
+        ids.update(found)
+        if isinstance(conn, RecipeConnection):
+            conn.pending_tag_ids.update(found)
+    return ids
+
+
+def insert_recipe(
+    conn: sqlite3.Connection, recipe: Recipe, group_id: int | None = None, json_children: bool = False
+) -> int:
+    """Insert a recipe and its child rows atomically.
+
+    The connection is expected to run with isolation_level=None so transactions
+    are managed explicitly. Without an open transaction the recipe gets its own
+    BEGIN IMMEDIATE/COMMIT. Inside a caller's transaction it is wrapped in a
+    savepoint instead: a failed insert is undone without touching the rest of
+    the caller's work, and nothing is committed until the caller commits.
+
+    With json_children=True the ingredients and tags are stored as JSON on the
+    recipe row instead of in the ingredients/tags tables and their join tables.
+    This writes far fewer rows, at the cost of the recipe not showing up in
+    queries that go through those tables.
+    """
+    owns_transaction = not conn.in_transaction
+    if owns_transaction and isinstance(conn, RecipeConnection):
+        # Anything still pending belongs to a transaction that ended without commit().
+        conn.clear_pending()
+    conn.execute("BEGIN IMMEDIATE" if owns_transaction else "SAVEPOINT insert_recipe")
+    try:
+        recipe_id = _insert_recipe_rows(conn, recipe, group_id, json_children)
+        if owns_transaction:
+            conn.commit()
+        else:
+            conn.execute("RELEASE insert_recipe")
+    except Exception:
+        if not owns_transaction:
+            conn.execute("ROLLBACK TO insert_recipe")
+            conn.execute("RELEASE insert_recipe")
+            if isinstance(conn, RecipeConnection):
+                # Ids created inside the savepoint no longer exist.
+                conn.clear_pending()
+        elif conn.in_transaction:
+            conn.rollback()
+        raise
+    return recipe_id
+
+
+def _insert_recipe_rows(conn: sqlite3.Connection, recipe: Recipe, group_id: int | None, json_children: bool) -> int:
+    # The models allow None list entries; there is nothing to store for them.
+    ingredients = [ri for ri in recipe.ingredients if ri is not None]
+    instructions = [instr for instr in recipe.instructions if instr is not None]
+    tags = [tag for tag in recipe.tags if tag is not None]
 
-    logger.info(f"Inserting recipe {recipe_id}, version {version}\n{recipe.model_dump()}")
+    ingredients_json: str | None = None
+    tags_json: str | None = None
+    if json_children:
+        ingredients_json = _ingredients_json.dump_json(ingredients).decode()
+        tags_json = _tags_json.dump_json(tags).decode()
+    recipe_id, version = conn.execute(
+        SQL_INSERT_RECIPE,
+        (group_id, group_id, recipe.title, recipe.description, recipe.comments, recipe.prep_time, recipe.cook_time,
+         recipe.servings, ingredients_json, tags_json)
+    ).fetchone()
+    # For a new recipe the set_recipe_group_id trigger has made recipe_id the group_id.
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Inserting recipe %s, version %s\n%s", recipe_id, version, recipe.model_dump_json())
 
     # Insert instructions
-    if recipe.instructions:
-        for instr in recipe.instructions:
-            conn.execute(
-                "INSERT INTO instructions (recipe_id, step_number, description) VALUES (?, ?, ?)",
-                (recipe_id, instr.step_number, instr.description)
-            )
+    if instructions:
+        instruction_rows = [(recipe_id, *_instruction_fields(instr)) for instr in instructions]
+        insert_rows(conn, SQL_INSERT_INSTRUCTION, instruction_rows)
+
+    if json_children:
+        return recipe_id
 
     # Insert ingredients and the join table rows
-    if recipe.ingredients:
-        for ri in recipe.ingredients:
-            ingredient_id = get_or_create_ingredient(conn, ri.ingredient)
-            conn.execute(
-                "INSERT INTO recipe_ingredients (recipe_id, ingredient_id, quantity, unit) VALUES (?, ?, ?, ?)",
-                (recipe_id, ingredient_id, ri.quantity, ri.unit)
-            )
+    if ingredients:
+        ingredient_ids = resolve_ingredient_ids(conn, [ri.ingredient for ri in ingredients])
+        ingredient_rows = [
+            (recipe_id, ingredient_ids[name], quantity, unit)
+            for name, quantity, unit in map(_recipe_ingredient_fields, ingredients)
+        ]
+        insert_rows(conn, SQL_INSERT_RECIPE_INGREDIENT, ingredient_rows)
 
     # Insert tags and recipe_tags join table rows
-    if recipe.tags:
-        for tag in recipe.tags:
-            tag_id = get_or_create_tag(conn, tag)
-            conn.execute(
-                "INSERT INTO recipe_tags (recipe_id, tag_id) VALUES (?, ?)",
-                (recipe_id, tag_id)
-            )
+    if tags:
+        tag_ids = resolve_tag_ids(conn, tags)
+        tag_rows = [(recipe_id, tag_ids[tag.name]) for tag in tags]
+        insert_rows(conn, SQL_INSERT_RECIPE_TAG, tag_rows)
 
-    conn.commit()
     return recipe_id
 
 # ------------------------------
 # Mock Recipes
 # ------------------------------
 
-def create_mock_recipes():
+def create_mock_recipes() -> tuple[Recipe, Recipe, Recipe]:
     # Original version of Pancakes
     pancakes_v1 = Recipe(
         title="Pancakes",
@@ -291,14 +585,22 @@ def create_mock_recipes():
 
 
 if __name__ == "__main__":
-    # Connect to an in-memory SQLite database
-    conn = sqlite3.connect("oppskrifter.db")
-    create_tables(conn)
+    conn = get_conn()
 
     pancakes_v1,  pancakes_v2, spaghetti_v1 = create_mock_recipes()
-    pancake_id = insert_recipe(conn=conn, recipe=pancakes_v1, group_id=None)
-    pancake_id = insert_recipe(conn=conn, recipe=pancakes_v2, group_id=pancake_id)
-    spaghetti_id = insert_recipe(conn=conn, recipe=spaghetti_v1, group_id=None)
-    conn.close()
-
-
+    try:
+        # One transaction for the whole batch so the commit cost is paid once.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            pancake_id = insert_recipe(conn=conn, recipe=pancakes_v1, group_id=None)
+            pancake_id = insert_recipe(conn=conn, recipe=pancakes_v2, group_id=pancake_id)
+            spaghetti_id = insert_recipe(conn=conn, recipe=spaghetti_v1, group_id=None)
+            conn.commit()
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+        # Give the planner statistics for the freshly loaded data.
+        conn.execute("ANALYZE")
+    finally:
+        close_conn()